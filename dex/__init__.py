@@ -3,4 +3,6 @@
 
 from .dexfile import DexFile
 from .basicblock import BasicBlock
-from .simplify import simplify
+from .simplify import simplify, simplify_parallel
+from .compact import CompactDex
+from .catalog import Catalog
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#coding=utf8
+
+from array import array
+from bisect import bisect_left
+from difflib import SequenceMatcher
+import logging as log
+log = log.getLogger(__name__)
+import os
+
+MAGIC = 'dex2dot catalog 2'
+
+def signature(clazz, mname, mtype):
+	''' one string per method, in the same format dexdump uses for invokes '''
+	return '%s.%s:%s' % (clazz, mname, mtype)
+
+def unsignature(sig):
+	''' the inverse of signature(): returns (class, name, type) '''
+	clazz, member = sig.split(';.', 1)
+	mname, mtype = member.split(':', 1)
+	return clazz + ';', mname, mtype
+
+class Catalog(object):
+	''' All methods with code in a dex, as a sorted array of signatures.
+	    Prefix lookups are a binary search; near-miss suggestions only look at
+	    a few neighbours plus methods with the same name or class. '''
+
+	def __init__(self, sigs):
+		self.sigs = sorted(set(sigs))
+		# indexes into sigs, sorted by "name:type"; lets us find a method by
+		# name even when the class is wrong.
+		member = lambda ix: (self.sigs[ix].split(';.', 1)[1], ix)
+		self.bymember = array('I', sorted(range(len(self.sigs)), key=member))
+
+	@staticmethod
+	def load(path):
+		''' Returns None if path is a catalog from another version. '''
+		with open(path, encoding='utf-8') as f:
+			if f.readline().strip() != MAGIC:
+				log.info('ignoring old catalog %s', path)
+				return None
+			# the signatures, a blank line, then the bymember indexes
+			sigs, _, order = f.read().partition('\n\n')
+		catalog = Catalog(())
+		catalog.sigs = [s for s in sigs.split('\n') if s] # already sorted
+		catalog.bymember = array('I', map(int, order.split()))
+		assert len(catalog.bymember) == len(catalog.sigs), 'broken ' + path
+		return catalog
+
+	def save(self, path):
+		tmppath = path + '.tmp'
+		with open(tmppath, 'w', encoding='utf-8') as f:
+			f.write(MAGIC + '\n')
+			for sig in self.sigs:
+				f.write(sig + '\n')
+			f.write('\n')
+			f.write(' '.join(map(str, self.bymember)) + '\n')
+		os.rename(tmppath, path)
+
+	def __len__(self):
+		return len(self.sigs)
+
+	def __contains__(self, sig):
+		ix = bisect_left(self.sigs, sig)
+		return ix < len(self.sigs) and self.sigs[ix] == sig
+
+	def _range(self, sorted_list, prefix):
+		# all entries starting with prefix form one run in a sorted list
+		start = bisect_left(sorted_list, prefix)
+		end = bisect_left(sorted_list, prefix + '\U0010ffff', start)
+		return start, end
+
+	def prefix(self, prefix=''):
+		''' signatures starting with prefix, sorted '''
+		start, end = self._range(self.sigs, prefix)
+		return self.sigs[start:end]
+
+	def classes(self, prefix=''):
+		''' classes starting with prefix, sorted '''
+		out = []
+		start, end = self._range(self.sigs, prefix)
+		for sig in self.sigs[start:end]:
+			clazz = sig.split(';.', 1)[0] + ';'
+			if not out or out[-1] != clazz:
+				out.append(clazz)
+		return out
+
+	def _memberrange(self, prefix):
+		# like _range, but for the "name:type" part, in bymember order
+		def first(key):
+			lo, hi = 0, len(self.bymember)
+			while lo < hi:
+				mid = (lo + hi) // 2
+				if self.sigs[self.bymember[mid]].split(';.', 1)[1] < key:
+					lo = mid + 1
+				else:
+					hi = mid
+			return lo
+		return first(prefix), first(prefix + '\U0010ffff')
+
+	def suggest(self, sig, count=5, cutoff=0.6):
+		''' up to count signatures that look like sig, best match first '''
+		# sig may be incomplete, so don't insist on all its parts
+		clazz, sep, member = sig.partition(';.')
+		mname = member.split(':', 1)[0]
+		candidates = set()
+
+		# typos late in the string sort close to the real thing
+		ix = bisect_left(self.sigs, sig)
+		candidates.update(self.sigs[max(0, ix-8):ix+8])
+
+		# wrong type or name in the right class
+		if sep:
+			start, end = self._range(self.sigs, clazz + sep)
+			candidates.update(self.sigs[start:min(end, start+200)])
+
+		# right name in the wrong class
+		if mname:
+			start, end = self._memberrange(mname + ':')
+			candidates.update(self.sigs[ix]
+			                  for ix in self.bymember[start:min(end, start+200)])
+
+		scored = []
+		for candidate in candidates:
+			ratio = SequenceMatcher(None, sig, candidate).ratio()
+			if ratio >= cutoff:
+				scored.append((-ratio, candidate))
+		scored.sort()
+		return [candidate for _, candidate in scored[:count]]
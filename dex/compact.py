@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+#coding=utf8
+
+from .basicblock import BasicBlock
+from .function import Function, AddressRange
+from array import array
+import logging as log
+log = log.getLogger(__name__)
+import re
+
+class StringTable(object):
+	''' Hands out one small int per distinct string, so repeated strings
+	    (class descriptors, opcode names...) are only stored once. '''
+
+	def __init__(self):
+		self.strings = [] # id -> string
+		self.ids = {}     # string -> id
+
+	def intern(self, string):
+		try:
+			return self.ids[string]
+		except KeyError:
+			ix = len(self.strings)
+			self.strings.append(string)
+			self.ids[string] = ix
+			return ix
+
+	def find(self, string):
+		''' like intern, but returns None instead of adding new strings '''
+		return self.ids.get(string)
+
+	def __getitem__(self, ix):
+		return self.strings[ix]
+
+	def __len__(self):
+		return len(self.strings)
+
+# instruction args are split around type descriptors, so the descriptors (the
+# big, repetitive part) become shared table entries.
+SPLITRE = re.compile(r'(\[*L[^;]+;)')
+
+# succ conditions; see makeblocks for what they mean.
+COND_NONE   = 0
+COND_TRUE   = 1
+COND_SWITCH = 2
+
+class CompactDex(object):
+	''' Holds many functions in a column-oriented form: every instruction,
+	    block, edge etc. of every function is a row in a few flat arrays, and
+	    all strings go through one StringTable. Functions are expanded back
+	    into normal Function objects on request. '''
+
+	def __init__(self):
+		self.strings = StringTable()
+		self.opcodes = StringTable()
+		self.funcs = {} # (class id, name id, type id) -> function index
+
+		# functions; *ix columns hold the start of each function's rows in
+		# some other column, plus one extra entry for the end of the last one.
+		self.fclazz   = array('I')
+		self.fname    = array('I')
+		self.ftype    = array('I')
+		self.faccess  = array('I')
+		self.ffileoff = array('I')
+		self.fregs    = array('H')
+		self.fargs    = array('H')
+		self.fblockix = array('I', [0])
+		self.fposix   = array('I', [0])
+		self.flocalix = array('I', [0])
+
+		# blocks (succ/catch targets are indexes relative to the function)
+		self.bname    = array('I')
+		self.binsnix  = array('I', [0])
+		self.bsuccix  = array('I', [0])
+		self.bcatchix = array('I', [0])
+
+		# edges
+		self.skind    = array('B')
+		self.svalue   = array('i')
+		self.sdst     = array('I')
+		self.cname    = array('I')
+		self.cdst     = array('I')
+
+		# instructions
+		self.iaddr    = array('I')
+		self.iop      = array('H')
+		self.iargix   = array('I', [0])
+		self.argtok   = array('I')
+
+		# positions and locals
+		self.pstart   = array('I')
+		self.pend     = array('I')
+		self.pline    = array('I')
+		self.lreg     = array('H')
+		self.lstart   = array('I')
+		self.lend     = array('I')
+		self.lname    = array('I')
+		self.ltype    = array('I')
+
+	def load(self, dexfile):
+		for func in dexfile.iterfuncs():
+			self.add(func)
+		log.info('loaded %d functions, %d instructions, %d strings',
+				len(self.funcs), len(self.iaddr), len(self.strings))
+		return self
+
+	def add(self, func):
+		intern = self.strings.intern
+		key = (intern(func.clazz), intern(func.name), intern(func.type))
+		assert key not in self.funcs, 'BUG: function added twice'
+		self.funcs[key] = len(self.fclazz)
+
+		self.fclazz.append(key[0])
+		self.fname.append(key[1])
+		self.ftype.append(key[2])
+		self.faccess.append(func.access)
+		self.ffileoff.append(func.fileoff)
+		self.fregs.append(func.regcount)
+		self.fargs.append(func.argcount)
+
+		blockix = dict((b, ix) for ix, b in enumerate(func.blocks))
+		for block in func.blocks:
+			self.bname.append(intern(block.name))
+			for addr, op, args in zip(block.addrs, block.ops, block.args):
+				self.iaddr.append(addr)
+				self.iop.append(self.opcodes.intern(op))
+				for tok in SPLITRE.split(args):
+					if tok:
+						self.argtok.append(intern(tok))
+				self.iargix.append(len(self.argtok))
+			self.binsnix.append(len(self.iaddr))
+
+			for cond, target in block.succ.items():
+				if cond is None:
+					self.skind.append(COND_NONE)
+					self.svalue.append(0)
+				elif cond is True:
+					self.skind.append(COND_TRUE)
+					self.svalue.append(0)
+				else:
+					assert type(cond) is int
+					self.skind.append(COND_SWITCH)
+					self.svalue.append(cond)
+				self.sdst.append(blockix[target])
+			self.bsuccix.append(len(self.sdst))
+
+			for caught, target in block.catches.items():
+				self.cname.append(intern(caught))
+				self.cdst.append(blockix[target])
+			self.bcatchix.append(len(self.cdst))
+		self.fblockix.append(len(self.bname))
+
+		for pos in func.lines:
+			self.pstart.append(pos.start)
+			self.pend.append(pos.end)
+			self.pline.append(pos.line)
+		self.fposix.append(len(self.pline))
+
+		for reg, regions in enumerate(func.locals):
+			for var in regions:
+				self.lreg.append(reg)
+				self.lstart.append(var.start)
+				self.lend.append(var.end)
+				self.lname.append(intern(var.name))
+				self.ltype.append(intern(var.type))
+		self.flocalix.append(len(self.lreg))
+
+	def __len__(self):
+		return len(self.funcs)
+
+	def __contains__(self, sig):
+		return self._key(*sig) is not None
+
+	def __iter__(self):
+		''' generates (class, name, type) for all functions '''
+		s = self.strings
+		for ix in range(len(self.fclazz)):
+			yield s[self.fclazz[ix]], s[self.fname[ix]], s[self.ftype[ix]]
+
+	def memsize(self):
+		''' approximate number of bytes held by this object '''
+		from sys import getsizeof
+		total = getsizeof(self.funcs)
+		total += sum(getsizeof(k) for k in self.funcs)
+		for table in (self.strings, self.opcodes):
+			total += getsizeof(table.strings) + getsizeof(table.ids)
+			total += sum(getsizeof(x) for x in table.strings)
+		for column in vars(self).values():
+			if type(column) is array:
+				total += getsizeof(column)
+		return total
+
+	def _key(self, clazz, mname, mtype):
+		key = tuple(self.strings.find(x) for x in (clazz, mname, mtype))
+		return key if key in self.funcs else None
+
+	def getfunc(self, clazz, mname, mtype):
+		''' Expands a function into a fresh Function; the caller may modify it
+		    (e.g. simplify it) without affecting the compact copy. '''
+		key = self._key(clazz, mname, mtype)
+		if key is None:
+			raise Exception('Method not found', clazz, mname, mtype)
+		fx = self.funcs[key]
+		s = self.strings
+
+		first, last = self.fblockix[fx], self.fblockix[fx+1]
+		blocks = []
+		for bx in range(first, last):
+			block = BasicBlock(s[self.bname[bx]])
+			for ix in range(self.binsnix[bx], self.binsnix[bx+1]):
+				toks = self.argtok[self.iargix[ix]:self.iargix[ix+1]]
+				block.addrs.append(self.iaddr[ix])
+				block.ops.append(self.opcodes[self.iop[ix]])
+				block.args.append(''.join(s[t] for t in toks))
+			blocks.append(block)
+
+		for bx, block in zip(range(first, last), blocks):
+			block.succ = {}
+			for ex in range(self.bsuccix[bx], self.bsuccix[bx+1]):
+				kind = self.skind[ex]
+				if kind == COND_NONE:
+					cond = None
+				elif kind == COND_TRUE:
+					cond = True
+				else:
+					cond = self.svalue[ex]
+				block.succ[cond] = blocks[self.sdst[ex]]
+			block.catches = {}
+			for ex in range(self.bcatchix[bx], self.bcatchix[bx+1]):
+				block.catches[s[self.cname[ex]]] = blocks[self.cdst[ex]]
+
+		positions = []
+		for px in range(self.fposix[fx], self.fposix[fx+1]):
+			pos = AddressRange(self.pstart[px], self.pend[px])
+			pos.line = self.pline[px]
+			positions.append(pos)
+
+		regcount = self.fregs[fx]
+		local = [[] for r in range(regcount)]
+		for lx in range(self.flocalix[fx], self.flocalix[fx+1]):
+			var = AddressRange(self.lstart[lx], self.lend[lx])
+			var.name = s[self.lname[lx]]
+			var.type = s[self.ltype[lx]]
+			local[self.lreg[lx]].append(var)
+
+		return Function(clazz, mname, mtype, self.faccess[fx],
+		                self.ffileoff[fx], regcount, self.fargs[fx],
+		                positions, local, tuple(blocks))
+
+if __name__ == '__main__':
+	# benchmark: make a big synthetic apk, with a cached disassembly next to
+	# it, and see how long loading it all takes and how much memory is kept.
+	from .dexfile import DexFile
+	from tempfile import mkdtemp
+	from zipfile import ZipFile, ZIP_DEFLATED
+	import os
+	import shutil
+	import sys
+	import time
+
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	fileoff = 0x100 # all methods share one code location, and switch table
+	header = [
+		"      access        : 0x0001 (PUBLIC)",
+		"      code          -",
+		"      registers     : 4",
+		"      ins           : 2",
+		"      outs          : 3",
+		"      insns size    : 32 16-bit code units",
+		"%06x:                                        |[%06x] x.y:()V" % (
+				fileoff - 0x10, fileoff - 0x10),
+	]
+	body = [
+		"|0000: const/4 v0, #int 0 // #0",
+		"|0001: if-eqz v3, 0012 // +0011",
+		"|0003: iget-object v1, v2, Lcom/example/pkg%(p)d/Cls%(c)d;.field%(m)d:Ljava/lang/String; // field@%(m)04x",
+		"|0005: invoke-virtual {v1}, Ljava/lang/String;.length:()I // method@0042",
+		"|0008: move-result v0",
+		"|0009: new-instance v1, Lcom/example/pkg%(p)d/Helper%(c)d; // type@%(c)04x",
+		"|000b: invoke-direct {v1, v3}, Lcom/example/pkg%(p)d/Helper%(c)d;.<init>:(Ljava/util/List;)V // method@%(m)04x",
+		"|000e: invoke-static {v1, v0}, Lcom/example/pkg%(p)d/Util;.check:(Ljava/lang/Object;I)Z // method@0100",
+		"|0011: move-result v0",
+		"|0012: packed-switch v0, 00000018 // +00000006",
+		"|0015: return v0",
+		"|0016: const/4 v0, #int 1 // #1",
+		"|0017: return v0",
+		"|0018: packed-switch-data (8 units)",
+	]
+	info = [
+		"      catches       : (none)",
+		"      positions     : ",
+		"        0x0000 line=10",
+		"        0x0009 line=12",
+		"      locals        : ",
+		"        0x0000 - 0x0018 reg=2 this Lcom/example/Foo; ",
+		"        0x0000 - 0x0018 reg=3 items Ljava/util/List; ",
+		"",
+	]
+	# packed-switch-data for the table at 0x18: keys 0 and 1, relative targets
+	table = bytes([0x00, 0x01, 0x02, 0x00, 0, 0, 0, 0, 4, 0, 0, 0, 3, 0, 0, 0])
+
+	def synth(n):
+		# ~3000 classes in 30 packages, 30-odd methods each
+		fmt = {'p': n % 30, 'c': n % 3000, 'm': n}
+		clazz = 'Lcom/example/pkg%d/Cls%d;' % (n % 30, n % 3000)
+		lines = ["    #%d              : (in %s)" % (n, clazz),
+		         "      name          : 'method%d'" % n,
+		         "      type          : '(Ljava/util/List;)I'"]
+		lines += header
+		lines += ['%06x: 0000' % fileoff + ' ' * 36 + line % fmt
+		          for line in body]
+		return lines + info
+
+	tmpdir = mkdtemp()
+	try:
+		# an 8 MiB classes.dex that doesn't compress well, like a real one
+		dexdata = bytearray(os.urandom(8 << 20))
+		dexdata[fileoff + 0x30:fileoff + 0x30 + len(table)] = table
+		apk = os.path.join(tmpdir, 'app.apk')
+		with ZipFile(apk, 'w', ZIP_DEFLATED) as z:
+			z.writestr('classes.dex', bytes(dexdata))
+		with open(os.path.join(tmpdir, 'app.disass'), 'w') as f:
+			for n in range(count):
+				f.write('\n'.join(synth(n)) + '\n')
+		os.utime(apk, (0, 0)) # so the disassembly counts as fresh
+
+		start = time.time()
+		dex = CompactDex().load(DexFile(apk))
+		elapsed = time.time() - start
+		size = dex.memsize()
+
+		print('functions:    %d' % len(dex))
+		print('instructions: %d' % len(dex.iaddr))
+		print('strings:      %d' % len(dex.strings))
+		print('opcodes:      %d' % len(dex.opcodes))
+		print('memory:       %.1f MiB (%.0f bytes/function)' % (
+				size / 2**20, size / count))
+		print('load time:    %.1f s (from DexFile, with %d switch tables)' % (
+				elapsed, count))
+
+		n = count - 1
+		sig = ('Lcom/example/pkg%d/Cls%d;' % (n % 30, n % 3000),
+		       'method%d' % n, '(Ljava/util/List;)I')
+		c = dex.getfunc(*sig)
+		orig = DexFile(apk).getfunc(*sig)
+		same = all((a.name, a.addrs, a.ops, a.args, list(a.succ)) ==
+		           (b.name, b.addrs, b.ops, b.args, list(b.succ))
+		           for a, b in zip(c.blocks, orig.blocks))
+	finally:
+		shutil.rmtree(tmpdir)
+	print()
+	print('Yay, round trip matches!' if same else 'MISMATCH!!!!')
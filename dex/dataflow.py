@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#coding=utf8
+
+''' Liveness and reaching definitions over a Function's basic blocks.
+
+    Register sets are plain ints used as bitsets (bit n = register vn), so
+    they scale to the 65535 registers dalvik allows. This works on the raw
+    dexdump instructions, so it must run before simplify() rewrites them. '''
+
+import heapq
+import logging as log
+log = log.getLogger(__name__)
+import re
+
+WIDE = ('long', 'double')
+
+# instructions that only read their registers
+USEONLY = ('goto', 'if-', 'packed-switch', 'sparse-switch', 'throw', 'return',
+           'invoke-', 'filled-new-array', 'fill-array-data', 'monitor-',
+           'check-cast', 'iput', 'sput', 'aput', 'nop')
+
+LISTRE  = re.compile(r'^\{([^}]*)\}')
+RANGERE = re.compile(r'^v(\d+) \.\. v(\d+)$')
+REGSRE  = re.compile(r'^(?:v\d+(?:, |$))+')
+
+def regs(args):
+	''' the register numbers an instruction's args refer to, in order '''
+	m = LISTRE.match(args)
+	if m:
+		inner = m.group(1).strip()
+		r = RANGERE.match(inner)
+		if r:
+			return list(range(int(r.group(1)), int(r.group(2)) + 1))
+		return [int(v.strip()[1:]) for v in inner.split(',') if v.strip()]
+	m = REGSRE.match(args)
+	if not m:
+		return []
+	return [int(v[1:]) for v in m.group(0).split(', ') if v]
+
+def _widths(base):
+	''' (is dst wide, [is src wide...]) for instructions writing their first
+	    register. Sources not in the list are narrow. '''
+	if '-to-' in base:
+		src, dst = base.split('-to-')
+		return dst in WIDE, [src in WIDE]
+	if base.startswith('cmp'):
+		wide = base.endswith(WIDE)
+		return False, [wide, wide]
+	if base == 'move-wide':
+		return True, [True]
+	if base.startswith(('aget-wide', 'iget-wide', 'sget-wide', 'const-wide',
+	                    'move-result-wide')):
+		return True, []
+	name, _, typ = base.rpartition('-')
+	if typ in WIDE:
+		# arithmetic; shift distances are ints even for longs
+		if name in ('shl', 'shr', 'ushr'):
+			return True, [True, False]
+		return True, [True, True]
+	return False, []
+
+def _bits(reg, wide):
+	return 3 << reg if wide else 1 << reg
+
+def defuse(op, args):
+	''' (defined, used) register bitsets of one instruction '''
+	rs = regs(args)
+	if not rs:
+		return 0, 0
+	base = op.split('/')[0]
+	if base.startswith(USEONLY):
+		used = 0
+		for ix, r in enumerate(rs):
+			# the value operand of wide stores/returns is a register pair
+			used |= _bits(r, ix == 0 and base.endswith('-wide'))
+		return 0, used
+	dstwide, srcwide = _widths(base)
+	defined = _bits(rs[0], dstwide)
+	srcs = rs[1:]
+	if op.endswith('/2addr'):
+		srcs = rs # vA is both source and destination
+	used = 0
+	for ix, r in enumerate(srcs):
+		used |= _bits(r, ix < len(srcwide) and srcwide[ix])
+	return defined, used
+
+def bitlist(bits):
+	''' register numbers in a bitset, lowest first '''
+	out = []
+	while bits:
+		low = bits & -bits
+		out.append(low.bit_length() - 1)
+		bits ^= low
+	return out
+
+def rpo(func):
+	''' blocks in reverse postorder from func_entry, following both normal and
+	    exception edges. Unreachable blocks go last, in their original order. '''
+	entry = func.blocks[0]
+	assert entry.name == 'func_entry'
+	seen = {entry}
+	post = []
+	stack = [(entry, iter(_successors(entry)))]
+	while stack:
+		block, children = stack[-1]
+		for child in children:
+			if child not in seen:
+				seen.add(child)
+				stack.append((child, iter(_successors(child))))
+				break
+		else:
+			stack.pop()
+			post.append(block)
+	order = post[::-1]
+	order.extend(b for b in func.blocks if b not in seen)
+	return order
+
+def _successors(block):
+	return list(block.succ.values()) + list(block.catches.values())
+
+def _solve(order, deps, transfer, start):
+	''' Generic worklist solver. order is the visiting priority; deps maps a
+	    block to the blocks that must be revisited when its value changes;
+	    transfer(block, values) computes a block's new value.
+
+	    Works in passes over order: a block queued behind the one being
+	    visited (i.e. by a back edge) waits for the next pass, instead of
+	    restarting the sweep from there. '''
+	prio = dict((b, ix) for ix, b in enumerate(order))
+	values = dict((b, start) for b in order)
+	heap = list(range(len(order)))
+	queued = set(heap)
+	later = set() # for the next pass
+	visits = 0
+	passes = 0
+	while heap:
+		passes += 1
+		while heap:
+			ix = heapq.heappop(heap)
+			queued.discard(ix)
+			block = order[ix]
+			visits += 1
+			new = transfer(block, values)
+			if new != values[block]:
+				values[block] = new
+				for dep in deps[block]:
+					dx = prio[dep]
+					if dx <= ix:
+						later.add(dx)
+					elif dx not in queued:
+						queued.add(dx)
+						heapq.heappush(heap, dx)
+		heap = sorted(later)
+		queued = later
+		later = set()
+	log.debug('  converged after %d visits of %d blocks in %d passes',
+	          visits, len(order), passes)
+	return values
+
+def liveness(func):
+	''' Returns (live_in, live_out): dicts of block -> register bitset.
+
+	    An exception can be thrown before any of a try block's own writes, so
+	    whatever is live into its handlers is live into the block, too. '''
+	log.info('computing liveness...')
+	use = {}
+	defs = {}
+	for block in func.blocks:
+		u = d = 0
+		for op, args in zip(block.ops, block.args):
+			defined, used = defuse(op, args)
+			u |= used & ~d
+			d |= defined
+		use[block] = u
+		defs[block] = d
+
+	preds = dict((b, []) for b in func.blocks)
+	for block in func.blocks:
+		for succ in _successors(block):
+			preds[succ].append(block)
+
+	def live_out(block, live_in):
+		out = 0
+		for succ in block.succ.values():
+			out |= live_in[succ]
+		return out
+
+	def transfer(block, live_in):
+		out = use[block] | (live_out(block, live_in) & ~defs[block])
+		for handler in block.catches.values():
+			out |= live_in[handler]
+		return out
+
+	# backward problem: visit in postorder
+	order = rpo(func)[::-1]
+	live_in = _solve(order, preds, transfer, 0)
+	return live_in, dict((b, live_out(b, live_in)) for b in func.blocks)
+
+def reaching(func):
+	''' Returns (definitions, reach_in). definitions is a list of (addr, reg)
+	    where addr is None for the function's arguments; reach_in maps each
+	    block to a bitset of indexes into definitions.
+
+	    Handlers are reached by everything reaching their try blocks, and by
+	    every definition made inside them. '''
+	log.info('computing reaching definitions...')
+	definitions = []
+	byreg = {} # register -> bitset of its definitions
+
+	def add(addr, reg):
+		bit = 1 << len(definitions)
+		definitions.append((addr, reg))
+		byreg[reg] = byreg.get(reg, 0) | bit
+		return bit
+
+	gens = {} # block -> [(definitions bitset, registers bitset)] in order
+	for r in range(func.regcount - func.argcount, func.regcount):
+		gens.setdefault(func.blocks[0], []).append((add(None, r), 1 << r))
+	for block in func.blocks:
+		steps = gens.setdefault(block, [])
+		for addr, op, args in zip(block.addrs, block.ops, block.args):
+			defined, _ = defuse(op, args)
+			bits = 0
+			for r in bitlist(defined):
+				bits |= add(addr, r)
+			if bits:
+				steps.append((bits, defined))
+
+	gen = {}
+	kill = {}
+	anydef = {}
+	for block, steps in gens.items():
+		g = k = a = 0
+		for bits, defined in steps:
+			killed = 0
+			for r in bitlist(defined):
+				killed |= byreg[r]
+			g = (g & ~killed) | bits
+			k |= killed
+			a |= bits
+		gen[block] = g
+		kill[block] = k
+		anydef[block] = a
+
+	preds = dict((b, []) for b in func.blocks)
+	catchpreds = dict((b, []) for b in func.blocks)
+	succs = dict((b, _successors(b)) for b in func.blocks)
+	for block in func.blocks:
+		for succ in block.succ.values():
+			preds[succ].append(block)
+		for handler in block.catches.values():
+			catchpreds[handler].append(block)
+
+	def reach_out(block, reach_in):
+		return gen[block] | (reach_in[block] & ~kill[block])
+
+	def transfer(block, reach_in):
+		bits = 0
+		for pred in preds[block]:
+			bits |= reach_out(pred, reach_in)
+		for pred in catchpreds[block]:
+			bits |= reach_in[pred] | anydef[pred]
+		return bits
+
+	reach_in = _solve(rpo(func), succs, transfer, 0)
+	return definitions, reach_in
+
+def annotations(func):
+	''' Returns block -> list of text lines describing live-in registers and
+	    the definitions reaching the block. '''
+	live_in, _ = liveness(func)
+	definitions, reach_in = reaching(func)
+	out = {}
+	for block in func.blocks:
+		live = ', '.join('v%d' % r for r in bitlist(live_in[block]))
+		where = []
+		for d in bitlist(reach_in[block]):
+			addr, reg = definitions[d]
+			if live_in[block] & (1 << reg):
+				where.append('v%d@%s' % (reg, 'arg' if addr is None
+				                                   else '%04x' % addr))
+		out[block] = ['live-in:  %s' % (live or '-'),
+		              'reaching: %s' % (', '.join(where) or '-')]
+	return out
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 #coding=utf8
 
+from .catalog import Catalog, signature
 from .function import createfunc
 from .utf8dex import *
 
-from os.path import dirname, splitext, exists, getmtime, isfile, islink
+from os.path import basename, dirname, join, splitext, exists, getmtime, \
+                    getsize, isfile, islink
 from select import select
 from subprocess import Popen, PIPE
 from tempfile import mkstemp
+from time import time
 
 import logging as log
 log = log.getLogger(__name__)
@@ -30,32 +33,151 @@ def le2u(bytes):
 def le2s(bytes):
 	return _from_little_endian(bytes, True)
 
+class DexEntry(object):
+	''' One of the dex files inside a zip (e.g. "classes2.dex"). Quacks enough
+	    like a DexFile for createfunc. '''
+	def __init__(self, dexfile, name):
+		self.dexfile = dexfile
+		self.name = name
+
+	def read_bytes(self, start, count):
+		return self.dexfile.read_bytes(start, count, self.name)
+
+	def read_switch_table(self, funcstart, tableaddr):
+		return self.dexfile.read_switch_table(funcstart, tableaddr, self.name)
+
 class DexFile(object):
-	def __init__(self, path):
+	def __init__(self, path, timeout=None):
+		''' timeout is how many seconds dexdump may go without printing
+		    anything before we give up on it; None picks one from the size of
+		    the input. '''
 		self.path = path
+		self.timeout = timeout
+		self._zipped = None   # is self.path a zip? found out on first read
+		self._entrydata = {}  # entry name -> unpacked bytes
 		if not exists(path):
 			raise Exception('File does not exist', path);
 
-	def _do_disass(self, disass_path):
-		log.info('disassembling %s into %s', self.path, disass_path)
+	def _entries(self):
+		''' (name, size) of the dex files to disassemble, in multidex order.
+		    The name is None for a plain dex file. '''
+		from zipfile import ZipFile, is_zipfile
+		if not is_zipfile(self.path):
+			return [(None, getsize(self.path))]
+		entryre = re.compile(r"^classes(\d*)\.dex$")
+		entries = []
+		with ZipFile(self.path) as z:
+			for info in z.infolist():
+				m = entryre.match(info.filename)
+				if m:
+					order = int(m.group(1) or 1)
+					entries.append((order, info.filename, info.file_size))
+		if not entries:
+			raise Exception('No classes.dex in file', self.path)
+		return [(name, size) for _, name, size in sorted(entries)]
+
+	def _run_dexdump(self, inpath, size, outpath, label):
+		''' Runs dexdump on inpath, writing to outpath only if it succeeds.
+		    label is what to call inpath in messages. '''
+		timeout = self.timeout
+		if timeout is None:
+			timeout = 10 + 2 * size / 2**20 # bigger inputs may pause longer
 		success = False
-		fd, tmppath = mkstemp(dir=dirname(disass_path), text=True)
+		child = None
+		fd, tmppath = mkstemp(dir=dirname(outpath), text=True)
 		try:
-			child = Popen(['dexdump', '-d', self.path], stdout=fd, stderr=PIPE)
-			_, err = child.communicate(timeout=10)
-			if len(err.strip()) > 0:
-				raise Exception('dexdump printed to stderr', err)
+			child = Popen(['dexdump', '-d', inpath], stdout=PIPE, stderr=PIPE)
+			err = b''
+			written = 0
+			classes = 0
+			tail = b''
+			last_output = last_report = time()
+			pipes = [child.stdout, child.stderr]
+			while pipes:
+				ready, _, _ = select(pipes, [], [], 1)
+				now = time()
+				if not ready and now - last_output > timeout:
+					raise Exception('dexdump printed nothing for too long',
+					                label, timeout)
+				for pipe in ready:
+					data = os.read(pipe.fileno(), 1 << 16)
+					if not data:
+						pipes.remove(pipe)
+					elif pipe is child.stderr:
+						err += data
+					else:
+						os.write(fd, data)
+						written += len(data)
+						classes += (tail + data).count(b'\nClass #')
+						tail = data[-7:]
+					last_output = now
+				if now - last_report >= 5:
+					log.info('  %s: %d KiB, %d classes so far', label,
+					         written >> 10, classes)
+					last_report = now
+			child.wait()
+			log.info('  %s: %d KiB, %d classes', label, written >> 10, classes)
 			if child.returncode != 0:
-				raise Exception('dexdump returned non-zero', child.returncode)
-			os.rename(tmppath, disass_path)
+				raise Exception('dexdump returned non-zero', child.returncode,
+				                err)
+			if len(err.strip()) > 0:
+				log.warning('dexdump printed to stderr: %s', err)
+			os.close(fd)
+			fd = None
+			os.rename(tmppath, outpath)
 			success = True
-		except TimeoutExpired:
-			child.kill()
 		finally:
-			os.close(fd)
+			if child is not None and child.returncode is None:
+				child.kill()
+				child.wait()
+			if fd is not None:
+				os.close(fd)
 			if not success:
 				os.remove(tmppath)
 
+	def _do_disass(self, disass_path):
+		''' Disassembles each dex entry into its own checkpoint file, then
+		    joins them. If we're interrupted, finished entries are kept, and
+		    the next run starts with the first unfinished one. '''
+		from zipfile import ZipFile
+		import shutil
+		log.info('disassembling %s into %s', self.path, disass_path)
+		partdir = disass_path + '.parts'
+		os.makedirs(partdir, exist_ok=True)
+		parts = []
+		for name, size in self._entries():
+			part = join(partdir, (name or basename(self.path)) + '.disass')
+			parts.append((name, part))
+			if exists(part) and getmtime(part) > getmtime(self.path):
+				log.info('  resuming after %s', part)
+				continue
+			if name is None:
+				self._run_dexdump(self.path, size, part, self.path)
+				continue
+			# dexdump wants a file, so unpack this entry for it
+			fd, tmpdex = mkstemp(dir=partdir, suffix='.dex')
+			try:
+				with os.fdopen(fd, 'wb') as out, ZipFile(self.path) as z:
+					with z.open(name) as src:
+						shutil.copyfileobj(src, out)
+				self._run_dexdump(tmpdex, size, part, name)
+			finally:
+				os.remove(tmpdex)
+
+		fd, tmppath = mkstemp(dir=dirname(disass_path), text=True)
+		try:
+			with os.fdopen(fd, 'wb') as out:
+				for name, part in parts:
+					if name is not None:
+						out.write(('dex2dot entry: %s\n' % name).encode())
+					with open(part, 'rb') as src:
+						shutil.copyfileobj(src, out)
+			os.rename(tmppath, disass_path)
+		except:
+			os.remove(tmppath)
+			raise
+		shutil.rmtree(partdir)
+
 	def _get_disass_path(self):
 		dfile = splitext(self.path)[0] + '.disass'
 		need_new = True
@@ -71,51 +193,154 @@ class DexFile(object):
 			self._do_disass(dfile)
 		return dfile
 
-	def getfunc(self, clazz, mname, mtype):
-		''' The args should be in "mangled" format. '''
+	def _methods(self, disass, wanted=None):
+		''' Generates (entry, class, name, type, code, info) for every method
+		    with code in the disassembly, in file order. Code and info are only
+		    collected for methods where wanted(class, name, type) is true (or
+		    for all methods, if wanted is None); otherwise they are None.
+		    entry is what createfunc needs for reading the method's dex. '''
 
-		dpath = self._get_disass_path()
-		with open(dpath, encoding='utf-8', errors='dex') as disass:
-			log.info('looking for function %s.%s%s', clazz, mname, mtype)
-			generator = (line.strip('\r\n') for line in disass)
+		generator = (line.strip('\r\n') for line in disass)
 
-			classre = re.compile(r"^\s*#\d+\s*: \(in (L\S+;)\)$")
-			namere  = re.compile(r"^\s*name\s*: '(\S+)'$")
-			typere  = re.compile(r"^\s*type\s*: '(\S+)'$")
-			for line in generator:
-				m = classre.match(line)
-				if m and m.group(1) == clazz:
-					# found the correct class
-					# name and type lines should be immediately below.
-					n = namere.match(next(generator)).group(1)
-					t = typere.match(next(generator)).group(1)
-					if n == mname and t == mtype:
-						break # next loop, please!
-			else:
-				raise Exception('Method not found', clazz, mname, mtype)
-
-			code = []
-			info = []
-			catchre = re.compile(r"^\s*catches\s+: ")
-			for line in generator:
-				m = catchre.match(line)
+		classre = re.compile(r"^\s*#\d+\s*: \(in (L\S+;)\)$")
+		namere  = re.compile(r"^\s*name\s*: '(\S+)'$")
+		typere  = re.compile(r"^\s*type\s*: '(\S+)'$")
+		codere  = re.compile(r"^\s*code\s*-\s*$")
+		catchre = re.compile(r"^\s*catches\s+: ")
+		entryre = re.compile(r"^dex2dot entry: (\S+)$")
+		entry = self
+		line = next(generator, None)
+		while line is not None:
+			m = classre.match(line)
+			if not m:
+				m = entryre.match(line)
 				if m:
-					info.append(line)
+					entry = DexEntry(self, m.group(1))
+				line = next(generator, None)
+				continue
+			# name and type lines should be immediately below. Fields look the
+			# same, but have no code section after the access line.
+			clazz = m.group(1)
+			n = namere.match(next(generator)).group(1)
+			t = typere.match(next(generator)).group(1)
+			access = next(generator)
+			line = next(generator, None)
+			if line is None or not codere.match(line):
+				continue # field, or abstract/native method
+
+			want = wanted is None or wanted(clazz, n, t)
+			code = [access, line] if want else None
+			info = [] if want else None
+			for line in generator:
+				if catchre.match(line):
+					if want:
+						info.append(line)
 					break # next loop!
-				code.append(line)
+				if want:
+					code.append(line)
 
 			for line in generator:
 				if len(line.strip()) == 0:
 					break # empty line means we're done!
-				info.append(line)
+				if want:
+					info.append(line)
 
-			return createfunc(self, clazz, mname, mtype, code, info)
+			yield entry, clazz, n, t, code, info
+			line = next(generator, None)
 
-	def read_bytes(self, start, count):
+	def _get_catalog_path(self):
+		return splitext(self.path)[0] + '.catalog'
+
+	def _cached_catalog(self, dpath):
+		cpath = self._get_catalog_path()
+		if exists(cpath) and getmtime(cpath) >= getmtime(dpath):
+			log.info('found cached catalog %s', cpath)
+			return Catalog.load(cpath)
+		return None
+
+	def getcatalog(self):
+		''' A Catalog of all methods with code; built in one pass over the
+		    disassembly, and cached next to it. '''
+
+		dpath = self._get_disass_path()
+		catalog = self._cached_catalog(dpath)
+		if catalog is None:
+			log.info('building catalog of %s', self.path)
+			with open(dpath, encoding='utf-8', errors='dex') as disass:
+				sigs = [signature(c, n, t) for _, c, n, t, _, _
+				        in self._methods(disass, lambda c, n, t: False)]
+			catalog = Catalog(sigs)
+			catalog.save(self._get_catalog_path())
+		return catalog
+
+	def getfunc(self, clazz, mname, mtype):
+		''' The args should be in "mangled" format. '''
+
+		dpath = self._get_disass_path()
+		sig = signature(clazz, mname, mtype)
+		catalog = self._cached_catalog(dpath)
+		if catalog is not None and sig not in catalog:
+			raise Exception('Method not found', clazz, mname, mtype,
+			                catalog.suggest(sig))
+
+		with open(dpath, encoding='utf-8', errors='dex') as disass:
+			log.info('looking for function %s.%s%s', clazz, mname, mtype)
+			seen = [] # only complete if we don't find it; then it's a catalog
+			def wanted(c, n, t):
+				seen.append(signature(c, n, t))
+				return (c, n, t) == (clazz, mname, mtype)
+			for entry, c, n, t, code, info in self._methods(disass, wanted):
+				if code is not None:
+					return createfunc(entry, clazz, mname, mtype, code, info)
+
+		catalog = Catalog(seen)
+		catalog.save(self._get_catalog_path())
+		raise Exception('Method not found', clazz, mname, mtype,
+		                catalog.suggest(sig))
+
+	def getfuncs(self, sigs):
+		''' Like getfunc, but finds many methods in one pass. sigs are
+		    (class, name, type) tuples; returns a dict from those to Functions.
+		    Methods that aren't in this dex are left out. '''
+
+		dpath = self._get_disass_path()
+		wanted = set(sigs)
+		catalog = self._cached_catalog(dpath)
+		if catalog is not None:
+			wanted = set(s for s in wanted if signature(*s) in catalog)
+		out = {}
+		if not wanted:
+			return out
+
+		with open(dpath, encoding='utf-8', errors='dex') as disass:
+			log.info('looking for %d functions', len(wanted))
+			want = lambda c, n, t: (c, n, t) in wanted
+			for entry, c, n, t, code, info in self._methods(disass, want):
+				if code is not None:
+					out[(c, n, t)] = createfunc(entry, c, n, t, code, info)
+					if len(out) == len(wanted):
+						break # got them all
+		return out
+
+	def iterfuncs(self):
+		''' Generates a Function for every method with code, in file order. '''
+
+		dpath = self._get_disass_path()
+		with open(dpath, encoding='utf-8', errors='dex') as disass:
+			log.info('loading all functions')
+			for entry, clazz, mname, mtype, code, info in self._methods(disass):
+				yield createfunc(entry, clazz, mname, mtype, code, info)
+
+	def read_bytes(self, start, count, entry='classes.dex'):
 		from zipfile import ZipFile, is_zipfile
-		if is_zipfile(self.path):
-			z = ZipFile(self.path)
-			data = z.read('classes.dex')
+		if self._zipped is None:
+			self._zipped = is_zipfile(self.path)
+		if self._zipped:
+			# unpacking is slow, and a big app has lots of switch tables
+			if entry not in self._entrydata:
+				with ZipFile(self.path) as z:
+					self._entrydata[entry] = z.read(entry)
+			data = self._entrydata[entry]
 			return data[start:start+count]
 		else:
 			assert self.path.endswith('.dex')
@@ -124,10 +349,10 @@ class DexFile(object):
 				with mmap(f.fileno(), 0, prot=PROT_READ) as m:
 					return m[start:start+count]
 
-	def read_switch_table(self, funcstart, tableaddr):
+	def read_switch_table(self, funcstart, tableaddr, entry='classes.dex'):
 		# https://source.android.com/devices/tech/dalvik/dalvik-bytecode.html#packed-switch
 		addr = funcstart + 2 * tableaddr
-		bytes = self.read_bytes(addr, 4)
+		bytes = self.read_bytes(addr, 4, entry)
 		ident = le2u(bytes[0:2])
 		size  = le2u(bytes[2:4])
 
@@ -135,7 +360,7 @@ class DexFile(object):
 		assert ident in (0x0100, 0x0200)
 		if ident == 0x0100:
 			# packed switch
-			bytes = self.read_bytes(addr+4, size * 4 + 4)
+			bytes = self.read_bytes(addr+4, size * 4 + 4, entry)
 			first_key = le2s(bytes[0:4])
 			for i in range(size):
 				key = first_key + i
@@ -144,7 +369,7 @@ class DexFile(object):
 				out[key] = target
 		else:
 			# sparse switch
-			bytes = self.read_bytes(addr+4, size * 8)
+			bytes = self.read_bytes(addr+4, size * 8, entry)
 			keys = bytes[0:size*4]
 			targets = bytes[size*4:]
 			for i in range(size):
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#coding=utf8
+
+from .simplify import invoketarget
+import logging as log
+log = log.getLogger(__name__)
+
+class Inlined(object):
+	''' A function in an inline expansion tree. parent is the node that first
+	    called it (None for the root); calls lists (block, node) pairs for every
+	    block of this function invoking another expanded function. '''
+	def __init__(self, func, parent, index):
+		self.func = func
+		self.parent = parent
+		self.index = index
+		self.depth = 0 if parent is None else parent.depth + 1
+		self.children = []
+		self.calls = []
+		if parent is not None:
+			parent.children.append(self)
+
+	def addcall(self, block, node):
+		if (block, node) not in self.calls:
+			self.calls.append((block, node))
+
+def expand(dexfile, func, depth, maxblocks):
+	''' Finds the methods func calls, the methods those call, and so on, up to
+	    depth calls away. Each level of calls is fetched in one pass over the
+	    disassembly. Methods already in the tree are just linked to again, so
+	    recursion ends, and no method is added once the whole tree would have
+	    more than maxblocks blocks. Must run before simplify, since it reads
+	    the raw invoke instructions.
+
+	    Returns all nodes; the root (for func) first, then in order of depth. '''
+	sig = lambda f: (f.clazz, f.name, f.type)
+	root = Inlined(func, None, 0)
+	nodes = [root]
+	seen = {sig(func): root}
+	total = len(func.blocks)
+	level = [root]
+	for d in range(depth):
+		log.info('expanding callees at depth %d', d + 1)
+		wanted = {} # signature -> [(caller node, calling block)], in call order
+		for node in level:
+			for block in node.func.blocks:
+				for op, args in zip(block.ops, block.args):
+					target = invoketarget(op, args)
+					if target is None:
+						continue
+					if target in seen:
+						node.addcall(block, seen[target])
+					else:
+						wanted.setdefault(target, []).append((node, block))
+		if not wanted:
+			break
+
+		found = dexfile.getfuncs(wanted.keys())
+		level = []
+		for target, callers in wanted.items():
+			callee = found.get(target)
+			if callee is None:
+				continue # not in this dex, e.g. a framework method
+			if total + len(callee.blocks) > maxblocks:
+				log.warning('not inlining %s.%s%s: over %d blocks',
+				            target[0], target[1], target[2], maxblocks)
+				continue
+			total += len(callee.blocks)
+			child = Inlined(callee, callers[0][0], len(nodes))
+			nodes.append(child)
+			seen[target] = child
+			level.append(child)
+			for node, block in callers:
+				node.addcall(block, child)
+	log.info('inlined %d functions, %d blocks in total', len(nodes)-1, total)
+	return nodes